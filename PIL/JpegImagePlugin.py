@@ -35,6 +35,9 @@
 __version__ = "0.6"
 
 import array, struct
+import io
+import operator
+import re
 from PIL import Image, ImageFile, _binary
 from PIL.JpegPresets import presets
 from PIL._util import isStringType
@@ -44,17 +47,25 @@ o8 = _binary.o8
 i16 = _binary.i16be
 i32 = _binary.i32be
 
+SCANBLOCK = 4096 # block size used when searching for the next marker
+
+_fill_bytes = re.compile(b"\xff+")
+
+_marker_code = struct.Struct(">H").unpack
+
 #
 # Parser
 
 def Skip(self, marker):
     n = i16(self.fp.read(2))-2
-    ImageFile._safe_read(self.fp, n)
+    if n > 0:
+        self.fp.seek(n, 1)
 
 def APP(self, marker):
     #
     # Application marker.  Store these in the APP dictionary.
-    # Also look for well-known application markers.
+    # Well-known application markers are parsed when the info
+    # dictionary is first used (see _getinfo).
 
     n = i16(self.fp.read(2))-2
     s = ImageFile._safe_read(self.fp, n)
@@ -64,50 +75,6 @@ def APP(self, marker):
     self.app[app] = s # compatibility
     self.applist.append((app, s))
 
-    if marker == 0xFFE0 and s[:4] == b"JFIF":
-        # extract JFIF information
-        self.info["jfif"] = version = i16(s, 5) # version
-        self.info["jfif_version"] = divmod(version, 256)
-        # extract JFIF properties
-        try:
-            jfif_unit = i8(s[7])
-            jfif_density = i16(s, 8), i16(s, 10)
-        except:
-            pass
-        else:
-            if jfif_unit == 1:
-                self.info["dpi"] = jfif_density
-            self.info["jfif_unit"] = jfif_unit
-            self.info["jfif_density"] = jfif_density
-    elif marker == 0xFFE1 and s[:5] == b"Exif\0":
-        # extract Exif information (incomplete)
-        self.info["exif"] = s # FIXME: value will change
-    elif marker == 0xFFE2 and s[:5] == b"FPXR\0":
-        # extract FlashPix information (incomplete)
-        self.info["flashpix"] = s # FIXME: value will change
-    elif marker == 0xFFE2 and s[:12] == b"ICC_PROFILE\0":
-        # Since an ICC profile can be larger than the maximum size of
-        # a JPEG marker (64K), we need provisions to split it into
-        # multiple markers. The format defined by the ICC specifies
-        # one or more APP2 markers containing the following data:
-        #   Identifying string      ASCII "ICC_PROFILE\0"  (12 bytes)
-        #   Marker sequence number  1, 2, etc (1 byte)
-        #   Number of markers       Total of APP2's used (1 byte)
-        #   Profile data            (remainder of APP2 data)
-        # Decoders should use the marker sequence numbers to
-        # reassemble the profile, rather than assuming that the APP2
-        # markers appear in the correct sequence.
-        self.icclist.append(s)
-    elif marker == 0xFFEE and s[:5] == b"Adobe":
-        self.info["adobe"] = i16(s, 5)
-        # extract Adobe custom properties
-        try:
-            adobe_transform = i8(s[1])
-        except:
-            pass
-        else:
-            self.info["adobe_transform"] = adobe_transform
-
 def COM(self, marker):
     #
     # Comment marker.  Store these in the APP dictionary.
@@ -145,25 +112,104 @@ def SOF(self, marker):
         raise SyntaxError("cannot handle %d-layer images" % self.layers)
 
     if marker in [0xFFC2, 0xFFC6, 0xFFCA, 0xFFCE]:
-        self.info["progressive"] = self.info["progression"] = 1
+        self._progressive = 1 # added to info by _getinfo
+
+    # 4-tuples: id, vsamp, hsamp, qtable
+    t = bytearray(s[6:])
+    for component, sampling, qtable in zip(t[0::3], t[1::3], t[2::3]):
+        self.layer.append((component, sampling >> 4, sampling & 15, qtable))
+
+def _jfif(info, s):
+    # extract JFIF information
+    if len(s) < 7:
+        return
+    info["jfif"] = version = i16(s, 5) # version
+    info["jfif_version"] = divmod(version, 256)
+    # extract JFIF properties
+    if len(s) >= 12:
+        jfif_unit = i8(s[7])
+        jfif_density = i16(s, 8), i16(s, 10)
+        if jfif_unit == 1:
+            info["dpi"] = jfif_density
+        info["jfif_unit"] = jfif_unit
+        info["jfif_density"] = jfif_density
+
+def _exif(info, s):
+    # extract Exif information (incomplete)
+    info["exif"] = s # FIXME: value will change
+
+def _flashpix(info, s):
+    # extract FlashPix information (incomplete)
+    info["flashpix"] = s # FIXME: value will change
+
+def _icc_profile(info, s):
+    # Since an ICC profile can be larger than the maximum size of
+    # a JPEG marker (64K), we need provisions to split it into
+    # multiple markers. The format defined by the ICC specifies
+    # one or more APP2 markers containing the following data:
+    #   Identifying string      ASCII "ICC_PROFILE\0"  (12 bytes)
+    #   Marker sequence number  1, 2, etc (1 byte)
+    #   Number of markers       Total of APP2's used (1 byte)
+    #   Profile data            (remainder of APP2 data)
+    # Decoders should use the marker sequence numbers to
+    # reassemble the profile, rather than assuming that the APP2
+    # markers appear in the correct sequence.  Collect the
+    # fragments here; _getinfo puts the profile together.
+    if len(s) < 14:
+        return
+    info.setdefault("icc_profile", []).append(s)
+
+def _adobe(info, s):
+    if len(s) < 7:
+        return
+    info["adobe"] = i16(s, 5)
+    # extract Adobe custom properties
+    if len(s) >= 12:
+        info["adobe_transform"] = i8(s[11])
+
+#
+# Well-known application markers, by marker name.  Each entry
+# lists the identifying prefixes used in that marker and their
+# handlers.
+
+APP_HANDLERS = {
+    "APP0": ((b"JFIF", _jfif),),
+    "APP1": ((b"Exif\0", _exif),),
+    "APP2": ((b"ICC_PROFILE\0", _icc_profile), (b"FPXR\0", _flashpix)),
+    "APP14": ((b"Adobe", _adobe),),
+}
+
+def _getinfo(self):
+    #
+    # Extract information from well-known application markers.
+    # This is done on demand, since callers that only want the
+    # pixel data never look at it.
+
+    info = {}
+
+    for app, s in self.applist:
+        for prefix, handler in APP_HANDLERS.get(app, ()):
+            if s.startswith(prefix):
+                handler(info, s)
+                break
 
-    if self.icclist:
+    icclist = info.get("icc_profile")
+    if icclist:
         # fixup icc profile
-        self.icclist.sort() # sort by sequence number
-        if i8(self.icclist[0][13]) == len(self.icclist):
-            profile = []
-            for p in self.icclist:
-                profile.append(p[14:])
-            icc_profile = b"".join(profile)
+        icclist.sort(key=operator.itemgetter(12)) # sort by sequence number
+        if i8(icclist[0][13]) == len(icclist):
+            profile = bytearray()
+            for p in icclist:
+                profile.extend(p[14:])
+            icc_profile = bytes(profile)
         else:
             icc_profile = None # wrong number of fragments
-        self.info["icc_profile"] = icc_profile
-        self.icclist = None
+        info["icc_profile"] = icc_profile
 
-    for i in range(6, len(s), 3):
-        t = s[i:i+3]
-        # 4-tuples: id, vsamp, hsamp, qtable
-        self.layer.append((t[0], i8(t[1])//16, i8(t[1])&15, i8(t[2])))
+    if self._progressive:
+        info["progressive"] = info["progression"] = 1
+
+    return info
 
 def DQT(self, marker):
     #
@@ -176,13 +222,14 @@ def DQT(self, marker):
 
     n = i16(self.fp.read(2))-2
     s = ImageFile._safe_read(self.fp, n)
-    while len(s):
-        if len(s) < 65:
+    offset = 0
+    while offset < len(s):
+        if len(s) - offset < 65:
             raise SyntaxError("bad quantization table marker")
-        v = i8(s[0])
+        v = i8(s[offset])
         if v//16 == 0:
-            self.quantization[v&15] = array.array("b", s[1:65])
-            s = s[65:]
+            self.quantization[v&15] = array.array("b", s[offset+1:offset+65])
+            offset = offset + 65
         else:
             return # FIXME: add code to read 16-bit tables!
             # raise SyntaxError, "bad quantization table element size"
@@ -257,6 +304,41 @@ MARKER = {
     0xFFFE: ("COM", "Comment", COM)
 }
 
+# same, indexed by the low byte of the marker code
+MARKER_TABLE = tuple(MARKER.get(0xFF00 | i) for i in range(256))
+
+
+def _skip_to_marker(fp):
+    # Skip fill bytes and stuffed or stray data, leaving the file
+    # positioned at the next marker code.  The data is searched a block
+    # at a time, so long runs of padding don't go through the Python
+    # interpreter one byte at a time.
+    offset = fp.tell()
+    lead = False
+    while True:
+        s = fp.read(SCANBLOCK)
+        if not s:
+            raise SyntaxError("no marker found")
+        i = 0
+        while True:
+            if not lead:
+                i = s.find(b"\xff", i)
+                if i < 0:
+                    break
+                lead = True
+            # skip fill bytes (any number of 0xFF may precede a marker)
+            m = _fill_bytes.match(s, i)
+            if m:
+                i = m.end()
+            if i >= len(s):
+                break
+            if s[i:i+1] != b"\x00":
+                fp.seek(offset + i)
+                return
+            # 0xFF00 is a stuffed data byte, not a marker
+            lead = False
+            i = i + 1
+        offset = offset + len(s)
 
 def _accept(prefix):
     return prefix[0:1] == b"\377"
@@ -286,32 +368,68 @@ class JpegImageFile(ImageFile.ImageFile):
         self.quantization = {}
         self.app = {} # compatibility
         self.applist = []
-        self.icclist = []
+        self._progressive = 0
 
-        while True:
+        # the info dictionary is built from the APP markers on demand
+        del self.info
 
-            s = s + self.fp.read(1)
-
-            i = i16(s)
-
-            if i in MARKER:
-                name, description, handler = MARKER[i]
-                # print hex(i), name, description
-                if handler is not None:
-                    handler(self, i)
-                if i == 0xFFDA: # start of scan
-                    rawmode = self.mode
-                    if self.mode == "CMYK":
-                        rawmode = "CMYK;I" # assume adobe conventions
-                    self.tile = [("jpeg", (0,0) + self.size, 0, (rawmode, ""))]
-                    # self.__offset = self.fp.tell()
-                    break
-                s = self.fp.read(1)
-            elif i == 0 or i == 65535:
-                # padded marker or junk; move on
-                s = "\xff"
-            else:
-                raise SyntaxError("no marker found")
+        fp = self.fp
+        if isinstance(fp, io.RawIOBase) and hasattr(io.BufferedReader, "detach"):
+            # unbuffered stream; read the header through a buffer instead
+            # of issuing a system call for every marker byte (detach is
+            # needed to hand the stream back, and is new in 2.7)
+            self.fp = io.BufferedReader(fp, ImageFile.MAXBLOCK)
+
+        read = self.fp.read
+
+        try:
+            while True:
+
+                s = s + read(1)
+                if len(s) < 2:
+                    raise SyntaxError("truncated marker")
+
+                i = _marker_code(s)[0]
+
+                if i >= 0xFF00:
+                    marker = MARKER_TABLE[i & 255]
+                else:
+                    marker = None
+
+                if marker is not None:
+                    name, description, handler = marker
+                    # print hex(i), name, description
+                    if handler is not None:
+                        handler(self, i)
+                    if i == 0xFFDA: # start of scan
+                        rawmode = self.mode
+                        if self.mode == "CMYK":
+                            rawmode = "CMYK;I" # assume adobe conventions
+                        self.tile = [("jpeg", (0,0) + self.size, 0, (rawmode, ""))]
+                        # self.__offset = self.fp.tell()
+                        break
+                    s = read(1)
+                elif i == 0 or i == 65535:
+                    # padded marker or junk; move on
+                    self.fp.seek(self.fp.tell() - 1)
+                    _skip_to_marker(self.fp)
+                    s = b"\xff"
+                else:
+                    raise SyntaxError("no marker found")
+        finally:
+            if self.fp is not fp:
+                # hand the original stream back, positioned where the
+                # parser stopped (detaching keeps it from being closed)
+                offset = self.fp.tell()
+                self.fp.detach()
+                self.fp = fp
+                fp.seek(offset)
+
+    def __getattr__(self, name):
+        if name == "info":
+            self.info = _getinfo(self)
+            return self.info
+        return ImageFile.ImageFile.__getattr__(self, name)
 
     def draft(self, mode, size):
 
@@ -343,16 +461,18 @@ class JpegImageFile(ImageFile.ImageFile):
 
         # ALTERNATIVE: handle JPEGs via the IJG command line utilities
 
-        import tempfile, os
-        f, path = tempfile.mkstemp()
-        os.close(f)
-        eval(self.filename)
-        if os.path.exists(self.filename):
-            os.system("djpeg '%s' >'%s'" % (self.filename, path))
-        else:
+        import tempfile, os, subprocess
+        if not os.path.exists(self.filename):
             raise ValueError("Invalid Filename")
 
+        f, path = tempfile.mkstemp()
         try:
+            # run djpeg directly (no shell); pass an absolute path so
+            # that the filename can't be mistaken for an option
+            with os.fdopen(f, "wb") as out:
+                subprocess.check_call(
+                    ["djpeg", os.path.abspath(self.filename)], stdout=out
+                    )
             self.im = Image.core.open_ppm(path)
         finally:
             try: os.unlink(path)
@@ -367,16 +487,17 @@ class JpegImageFile(ImageFile.ImageFile):
         return _getexif(self)
 
 
+def _fixup(value):
+    # unwrap single-valued EXIF tags
+    if len(value) == 1:
+        return value[0]
+    return value
+
 def _getexif(self):
     # Extract EXIF information.  This method is highly experimental,
     # and is likely to be replaced with something better in a future
     # version.
     from PIL import TiffImagePlugin
-    import io
-    def fixup(value):
-        if len(value) == 1:
-            return value[0]
-        return value
     # The EXIF record consists of a TIFF file embedded in a JPEG
     # application marker (!).
     try:
@@ -390,7 +511,7 @@ def _getexif(self):
     info = TiffImagePlugin.ImageFileDirectory(head)
     info.load(file)
     for key, value in info.items():
-        exif[key] = fixup(value)
+        exif[key] = _fixup(value)
     # get exif extension
     try:
         file.seek(exif[0x8769])
@@ -400,7 +521,7 @@ def _getexif(self):
         info = TiffImagePlugin.ImageFileDirectory(head)
         info.load(file)
         for key, value in info.items():
-            exif[key] = fixup(value)
+            exif[key] = _fixup(value)
     # get gpsinfo extension
     try:
         file.seek(exif[0x8825])
@@ -411,7 +532,7 @@ def _getexif(self):
         info.load(file)
         exif[0x8825] = gps = {}
         for key, value in info.items():
-            gps[key] = fixup(value)
+            gps[key] = _fixup(value)
     return exif
 
 # --------------------------------------------------------------------
@@ -442,10 +563,15 @@ samplings = {
              (2, 2, 1, 1, 1, 1): 2,
             }
 
+_zigzag = operator.itemgetter(*zigzag_index)
+
+# APP2 marker, segment length, identifier, sequence number, marker count
+_icc_header = struct.Struct(">2sH12sBB")
+
 def convert_dict_qtables(qtables):
-    qtables = [qtables[key] for key in xrange(len(qtables)) if qtables.has_key(key)]
+    qtables = [qtables[key] for key in range(len(qtables)) if key in qtables]
     for idx, table in enumerate(qtables):
-        qtables[idx] = [table[i] for i in zigzag_index]
+        qtables[idx] = list(_zigzag(table))
     return qtables
 
 def get_sampling(im):
@@ -467,6 +593,15 @@ def _save(im, fp, filename):
     subsampling = info.get("subsampling", -1)
     qtables = info.get("qtables")
 
+    # "progressive" is the official name, but older documentation
+    # says "progression"
+    # FIXME: issue a warning if the wrong form is used (post-1.1.7)
+    progressive = "progressive" in info or "progression" in info
+
+    optimize = "optimize" in info
+
+    exif = info.get("exif", b"")
+
     if quality == "keep":
         quality = 0
         subsampling = "keep"
@@ -514,14 +649,16 @@ def _save(im, fp, filename):
             if not (0 < len(qtables) < 5):
                 raise ValueError("None or too many quantization tables")
             for idx, table in enumerate(qtables):
+                # the array constructor checks the type and range of
+                # every entry in a single pass
                 try:
                     if len(table) != 64:
-                        raise
+                        raise TypeError
                     table = array.array('b', table)
-                except TypeError:
+                except (TypeError, OverflowError):
                     raise ValueError("Invalid quantization table")
                 else:
-                    qtables[idx] = list(table)
+                    qtables[idx] = table.tolist()
             return qtables
 
     if qtables == "keep":
@@ -537,45 +674,44 @@ def _save(im, fp, filename):
         ICC_OVERHEAD_LEN = 14
         MAX_BYTES_IN_MARKER = 65533
         MAX_DATA_BYTES_IN_MARKER = MAX_BYTES_IN_MARKER - ICC_OVERHEAD_LEN
-        markers = []
-        while icc_profile:
-            markers.append(icc_profile[:MAX_DATA_BYTES_IN_MARKER])
-            icc_profile = icc_profile[MAX_DATA_BYTES_IN_MARKER:]
+        markers = [icc_profile[i:i+MAX_DATA_BYTES_IN_MARKER]
+                   for i in range(0, len(icc_profile), MAX_DATA_BYTES_IN_MARKER)]
+        data = bytearray()
         i = 1
         for marker in markers:
-            size = struct.pack(">H", 2 + ICC_OVERHEAD_LEN + len(marker))
-            extra = extra + (b"\xFF\xE2" + size + b"ICC_PROFILE\0" + o8(i) + o8(len(markers)) + marker)
+            data += _icc_header.pack(b"\xFF\xE2", 2 + ICC_OVERHEAD_LEN + len(marker),
+                                     b"ICC_PROFILE\0", i, len(markers))
+            data += marker
             i = i + 1
+        extra = bytes(data)
 
     # get keyword arguments
     im.encoderconfig = (
         quality,
-        # "progressive" is the official name, but older documentation
-        # says "progression"
-        # FIXME: issue a warning if the wrong form is used (post-1.1.7)
-        "progressive" in info or "progression" in info,
+        progressive,
         info.get("smooth", 0),
-        "optimize" in info,
+        optimize,
         info.get("streamtype", 0),
         dpi[0], dpi[1],
         subsampling,
         qtables,
         extra,
-        info.get("exif", b"")
+        exif
         )
 
 
     # if we optimize, libjpeg needs a buffer big enough to hold the whole image in a shot.
-    # Guessing on the size, at im.size bytes. (raw pizel size is channels*size, this
-    # is a value that's been used in a django patch.
+    # Size it for the raw pixel data (channels*size) plus some room for the headers;
+    # guessing at im.size bytes, as a django patch did, is too small for colour images
+    # saved at high quality.
     # https://github.com/jdriscoll/django-imagekit/issues/50
     bufsize=0
-    if "optimize" in info or "progressive" in info or "progression" in info:
-        bufsize = im.size[0]*im.size[1]
+    if optimize or progressive:
+        bufsize = im.size[0]*im.size[1]*len(im.getbands()) + 1024
 
     # The exif info needs to be written as one block, + APP1, + one spare byte.
     # Ensure that our buffer is big enough
-    bufsize = max(ImageFile.MAXBLOCK, bufsize, len(info.get("exif",b"")) + 5 )
+    bufsize = max(ImageFile.MAXBLOCK, bufsize, len(exif) + 5 )
 
     ImageFile._save(im, fp, [("jpeg", (0,0)+im.size, 0, rawmode)], bufsize)
 
@@ -44,6 +44,48 @@ def test_app():
     assert_equal(im.applist[1], ("COM", b"Python Imaging Library"))
     assert_equal(len(im.applist), 2)
 
+def test_unbuffered():
+    # Header parsing must not consume or close an unbuffered stream
+    import io
+    fp = io.FileIO(file)
+    im = Image.open(fp)
+    assert_equal(im.size, (128, 128))
+    assert_false(fp.closed)
+    im.load()
+
+def test_fill_bytes():
+    # Any number of 0xFF fill bytes may precede a marker
+    im = Image.open(BytesIO(data[:2] + b"\xff" * 5000 + data[2:]))
+    assert_equal(im.size, (128, 128))
+    assert_equal(im.applist, Image.open(file).applist)
+
+def late_app_data():
+    # progressive version of the sample, with APP1 and APP2 segments
+    # placed after the frame header
+    import struct
+    i = data.index(b"\xff\xc0")
+    j = i + 2 + struct.unpack(">H", data[i+2:i+4])[0]
+    exif = b"Exif\0\0MM\0*\0\0\0\x08"
+    icc = b"ICC_PROFILE\0\x01\x01" + b"profile"
+    return (data[:i] + b"\xff\xc2" + data[i+2:j] +
+            b"\xff\xe1" + struct.pack(">H", 2 + len(exif)) + exif +
+            b"\xff\xe2" + struct.pack(">H", 2 + len(icc)) + icc +
+            data[j:])
+
+def test_late_app():
+    # APP segments after a progressive frame header end up in info
+    im = Image.open(BytesIO(late_app_data()))
+    assert_equal(im.info.get("progressive"), 1)
+    assert_equal(im.info.get("exif"), b"Exif\0\0MM\0*\0\0\0\x08")
+    assert_equal(im.info.get("icc_profile"), b"profile")
+
+def test_short_icc():
+    # an ICC segment too short to hold the sequence header is ignored
+    icc = b"\xff\xe2\x00\x0eICC_PROFILE\0"
+    im = Image.open(BytesIO(data[:2] + icc + data[2:]))
+    assert_false("icc_profile" in im.info)
+    assert_equal(im.applist[0], ("APP2", b"ICC_PROFILE\0"))
+
 def test_cmyk():
     # Test CMYK handling.  Thanks to Tim and Charlie for test data,
     # Michael for getting me to look one more time.
@@ -62,6 +104,13 @@ def test_cmyk():
     c, m, y, k = [x / 255.0 for x in im.getpixel((im.size[0]-1, im.size[1]-1))]
     assert_true(k > 0.9)
 
+def test_adobe():
+    # The color transform flag is the last byte of the APP14 segment
+    im = Image.open("Tests/images/pil_sample_cmyk.jpg")
+    assert_equal(im.info["adobe_transform"], 2)
+    im = Image.open("Tests/images/pil_sample_rgb.jpg")
+    assert_equal(im.info["adobe_transform"], 1)
+
 def test_dpi():
     def test(xdpi, ydpi=None):
         im = Image.open(file)
@@ -187,6 +236,11 @@ def test_subsampling():
 
     assert_exception(TypeError, lambda: roundtrip(lena(), subsampling="1:1:1"))
 
+def test_invalid_qtables():
+    # wrong size, out of range and non-numeric tables are rejected
+    for table in ((1,)*63, (1000,)*64, ("a",)*64):
+        assert_exception(ValueError, lambda: roundtrip(lena(), qtables=(table,)))
+
 def test_exif():
     im = Image.open("Tests/images/pil_sample_rgb.jpg")
     info = im._getexif()